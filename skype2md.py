@@ -1,22 +1,123 @@
 import json
 import os
 import re
+import sys
 from datetime import datetime, timezone
+from functools import lru_cache, partial
+from itertools import chain, groupby
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# One pass for emoji, bold, italic and strikethrough, run after anchors.
+# Tag names are matched exactly, so <br>, <img> and <span> are left alone
+# rather than being read as <b>, <i> or <s>. Overlapping tags such as
+# <b>1<i>2</b>3</i> convert outer-first and keep the leftover tags as text,
+# <ss> without utf= is not converted, and an <ss> wrapping <a> markup sees
+# the anchor already converted.
+INLINE_RE = re.compile(
+    r'<ss\s[^>]*?utf="(?P<emoji>[^"]*)"[^>]*>.*?</ss>'
+    r"|<b(?:\s[^>]*)?>(?P<b>.*?)</b>"
+    r"|<i(?:\s[^>]*)?>(?P<i>.*?)</i>"
+    r"|<s(?:\s[^>]*)?>(?P<s>.*?)</s>",
+    re.DOTALL,
+)
+INLINE_MARKERS = {"b": "**", "i": "*", "s": "~~"}
+DOC_ID_RE = re.compile(r'doc_id="([^"]*)"')
+INITIATOR_RE = re.compile(r"<initiator>(.*?)</initiator>")
+EVENTTIME_RE = re.compile(r"<eventtime>(.*?)</eventtime>")
+ROSTERVER_RE = re.compile(r"<rosterVersion>(.*?)</rosterVersion>")
+TARGET_RE = re.compile(r"<target>(.*?)</target>")
+PART_RE = re.compile(
+    r'<part.*?identity="(.*?)".*?<name>(.*?)</name>.*?<duration>(.*?)</duration>.*?</part>',
+    re.DOTALL,
+)
+LEGACY_QUOTE_RE = re.compile(r"<legacyquote>.*?</legacyquote>", re.DOTALL)
+
+IMAGE_EXTS = frozenset({".png", ".jpg", ".jpeg", ".gif", ".webp"})
+MERGE_SECONDS = 30
+OUTPUT_BUFFER_SIZE = 1 << 20
+
+
+def parse_iso_to_utc(ts: str) -> datetime:
+    dt_utc = None
+    # Fast path for the fixed-width "YYYY-MM-DDTHH:MM:SS[.ffffff]Z" shape
+    if (
+        len(ts) >= 20
+        and ts[-1] == "Z"
+        and ts[4] == ts[7] == "-"
+        and ts[10] == "T"
+        and ts[13] == ts[16] == ":"
+    ):
+        digits = ts[0:4] + ts[5:7] + ts[8:10] + ts[11:13] + ts[14:16] + ts[17:19]
+        frac = ts[20:-1]
+        if (
+            digits.isascii()
+            and digits.isdigit()
+            and (
+                len(ts) == 20
+                or (
+                    ts[19] == "."
+                    and len(frac) <= 6
+                    and frac.isascii()
+                    and frac.isdigit()
+                )
+            )
+        ):
+            try:
+                dt_utc = datetime(
+                    int(ts[0:4]),
+                    int(ts[5:7]),
+                    int(ts[8:10]),
+                    int(ts[11:13]),
+                    int(ts[14:16]),
+                    int(ts[17:19]),
+                    int(frac.ljust(6, "0")) if frac else 0,
+                    tzinfo=timezone.utc,
+                )
+            except ValueError:
+                pass
+
+    if dt_utc is None:
+        fmts = [
+            "%Y-%m-%dT%H:%M:%S.%fZ",
+            "%Y-%m-%dT%H:%M:%SZ",
+        ]
+        for fmt in fmts:
+            try:
+                dt_utc = datetime.strptime(ts, fmt).replace(tzinfo=timezone.utc)
+                break
+            except ValueError:
+                pass
+    return dt_utc
+
+
+def utc_to_local(dt_utc: datetime) -> datetime:
+    return dt_utc.astimezone(tz=None).replace(tzinfo=None)
 
 
-def parse_iso_to_local(ts: str) -> datetime:
-    fmts = [
-        "%Y-%m-%dT%H:%M:%S.%fZ",
-        "%Y-%m-%dT%H:%M:%SZ",
-    ]
-    for fmt in fmts:
+def load_json(fp):
+    raw = fp.read()
+    if orjson is not None:
         try:
-            dt_utc = datetime.strptime(ts, fmt)
-            dt_local = dt_utc.replace(tzinfo=timezone.utc).astimezone(tz=None)
-            return dt_local.replace(tzinfo=None)
-        except ValueError:
+            return orjson.loads(raw)
+        except orjson.JSONDecodeError:
+            # orjson rejects lone surrogates, a BOM and NaN; json accepts them
             pass
-    return None
+    return json.loads(raw)
+
+
+def doc_id_to_md_link(doc_id: str, media_files: dict) -> str:
+    if doc_id not in media_files:
+        return f"[{doc_id}](media/{doc_id})"
+    fname = media_files[doc_id]
+    lower_ext = os.path.splitext(fname)[1].lower()
+    if lower_ext in IMAGE_EXTS:
+        return f"![{fname}](media/{fname})"
+    else:
+        return f"[{fname}](media/{fname})"
 
 
 def format_dt(dt: datetime) -> str:
@@ -36,6 +137,45 @@ def is_probably_system_id(sender_id: str, conversation_id: str) -> bool:
     return False
 
 
+def group_by_sender(order, sids, snames):
+    # Every run is labelled with its first message's display name, including
+    # a leading run whose sender id is None ("from": null).
+    for _, run in groupby(order, key=sids.__getitem__):
+        first = next(run)
+        yield snames[first], chain((first,), run)
+
+
+def merge_blocks(groups, dts, stamps, contents, merge_seconds):
+    # Deltas use the UTC stamps so a DST fall-back, where local time runs
+    # backwards, does not merge messages that are far apart.
+    for sender_name, block in groups:
+        merged_block = []
+        block_iter = iter(block)
+        first = next(block_iter)
+        cur_dt = dts[first]
+        cur_stamp = stamps[first]
+        sub_msgs = [contents[first]]
+
+        for i in block_iter:
+            next_dt = dts[i]
+            if not (cur_dt and next_dt):
+                merged_block.append((cur_dt, sub_msgs))
+                cur_dt, cur_stamp = next_dt, stamps[i]
+                sub_msgs = [contents[i]]
+                continue
+
+            delta = stamps[i] - cur_stamp
+            if delta < merge_seconds:
+                sub_msgs.append(contents[i])
+            else:
+                merged_block.append((cur_dt, sub_msgs))
+                cur_dt, cur_stamp = next_dt, stamps[i]
+                sub_msgs = [contents[i]]
+
+        merged_block.append((cur_dt, sub_msgs))
+        yield sender_name, merged_block
+
+
 def main():
     export_dir = "."
     msg_file = os.path.join(export_dir, "messages.json")
@@ -45,8 +185,8 @@ def main():
         print("messages.json not found.")
         return
 
-    with open(msg_file, "r", encoding="utf-8") as f:
-        data = json.load(f)
+    with open(msg_file, "rb") as f:
+        data = load_json(f)
 
     user_id = data.get("userId", "")
 
@@ -55,6 +195,7 @@ def main():
         print("No conversations found.")
         return
 
+    lines = []
     for i, c in enumerate(convs):
         conv_name = c.get("displayName") or "Unnamed"
         thread_props = c.get("threadProperties") or {}
@@ -69,7 +210,8 @@ def main():
             elif isinstance(raw_members, list):
                 members_list = raw_members
         members_str = ", ".join(members_list) if members_list else "No members listed"
-        print(f"[{i}] {conv_name} | Members: {members_str}")
+        lines.append(f"[{i}] {conv_name} | Members: {members_str}")
+    sys.stdout.write("\n".join(lines) + "\n")
 
     choice = input(f"Enter conversation index (0..{len(convs)-1}): ")
     try:
@@ -86,60 +228,55 @@ def main():
 
     conversation_id = conversation.get("id", "")
     chat_name = conversation.get("displayName", f"chat_{choice}")
+    system_cache = {}
 
     media_files = {}
     if os.path.isdir(media_dir):
-        for fname in os.listdir(media_dir):
-            base = fname.split(".", 1)[0]
-            media_files[base] = fname
+        with os.scandir(media_dir) as entries:
+            for entry in entries:
+                fname = entry.name
+                media_files[fname.partition(".")[0]] = fname
 
     quote_pattern = re.compile(
         r'<quote.*?authorname="(.*?)".*?>(.*?)</quote>', re.DOTALL
     )
     partlist_pattern = re.compile(r"<partlist.*?>(.*?)</partlist>", re.DOTALL)
-    part_pattern = re.compile(
-        r'<part.*?identity="(.*?)".*?<name>(.*?)</name>.*?<duration>(.*?)</duration>.*?</part>',
-        re.DOTALL,
-    )
-    emoji_pattern = re.compile(r'<ss.*?utf="(.*?)".*?>.*?</ss>', re.DOTALL)
     addmember_pattern = re.compile(r"<addmember>(.*?)</addmember>", re.DOTALL)
     anchor_pattern = re.compile(r'<a href="(.*?)">(.*?)</a>', re.DOTALL)
 
     def convert_quote(m):
         author = m.group(1)
         text = m.group(2)
-        text = re.sub(
-            r"<legacyquote>.*?</legacyquote>", "", text, flags=re.DOTALL
-        ).strip()
+        if "<legacyquote>" in text:
+            text = LEGACY_QUOTE_RE.sub("", text)
+        text = text.strip()
         return f"> **Quoted from {author}**\n> {text.replace('\n', '\n> ')}"
 
     def convert_partlist(m):
         inside = m.group(1)
-        parts = part_pattern.findall(inside)
-        lines = ["**Call ended**"]
-        for identity, name, duration in parts:
-            lines.append(f"- {name} ({duration}s)")
-        return "\n".join(lines)
-
-    def convert_emoji(m):
-        return m.group(1)
-
-    def convert_bold(m):
-        return f"**{m.group(1)}**"
-
-    def convert_italic(m):
-        return f"*{m.group(1)}*"
+        if "<part" not in inside:
+            return "**Call ended**"
+        return "**Call ended**" + "".join(
+            f"\n- {p.group(2)} ({p.group(3)}s)" for p in PART_RE.finditer(inside)
+        )
 
-    def convert_strikethrough(m):
-        return f"~~{m.group(1)}~~"
+    def convert_inline(m):
+        kind = m.lastgroup
+        if kind == "emoji":
+            return m.group("emoji")
+        inner = m.group(kind)
+        if "<" in inner:
+            inner = INLINE_RE.sub(convert_inline, inner)
+        marker = INLINE_MARKERS[kind]
+        return f"{marker}{inner}{marker}"
 
     def convert_addmember(m):
         inside = m.group(1)
 
-        initiator = re.search(r"<initiator>(.*?)</initiator>", inside)
-        eventtime = re.search(r"<eventtime>(.*?)</eventtime>", inside)
-        rosterver = re.search(r"<rosterVersion>(.*?)</rosterVersion>", inside)
-        targets = re.findall(r"<target>(.*?)</target>", inside)
+        initiator = INITIATOR_RE.search(inside)
+        eventtime = EVENTTIME_RE.search(inside)
+        rosterver = ROSTERVER_RE.search(inside)
+        targets = TARGET_RE.findall(inside)
 
         initiator_val = initiator.group(1) if initiator else "Unknown"
         eventtime_val = eventtime.group(1) if eventtime else "N/A"
@@ -161,125 +298,92 @@ def main():
         return f"[{text}]({href})"
 
     def convert_rich_text(content: str) -> str:
-        content = quote_pattern.sub(convert_quote, content)
-        content = partlist_pattern.sub(convert_partlist, content)
-        content = addmember_pattern.sub(convert_addmember, content)
-        content = emoji_pattern.sub(convert_emoji, content)
-        content = anchor_pattern.sub(convert_anchor, content)
-        content = re.sub(r"<b[^>]*>(.*?)</b>", convert_bold, content, flags=re.DOTALL)
-        content = re.sub(r"<i[^>]*>(.*?)</i>", convert_italic, content, flags=re.DOTALL)
-        content = re.sub(
-            r"<s[^>]*>(.*?)</s>", convert_strikethrough, content, flags=re.DOTALL
-        )
-        return content
-
-    def doc_id_to_md_link(doc_id: str) -> str:
-        if doc_id not in media_files:
-            return f"[{doc_id}](media/{doc_id})"
-        fname = media_files[doc_id]
-        lower_ext = os.path.splitext(fname)[1].lower()
-        image_exts = [".png", ".jpg", ".jpeg", ".gif", ".webp"]
-        if lower_ext in image_exts:
-            return f"![{fname}](media/{fname})"
-        else:
-            return f"[{fname}](media/{fname})"
+        if "<" not in content:
+            return content
+        if "<quote" in content:
+            content = quote_pattern.sub(convert_quote, content)
+        if "<partlist" in content:
+            content = partlist_pattern.sub(convert_partlist, content)
+        if "<addmember" in content:
+            content = addmember_pattern.sub(convert_addmember, content)
+        if "<a " in content:
+            content = anchor_pattern.sub(convert_anchor, content)
+        return INLINE_RE.sub(convert_inline, content)
+
+    link_for = lru_cache(maxsize=None)(
+        partial(doc_id_to_md_link, media_files=media_files)
+    )
 
-    processed_msgs = []
+    dts = []
+    stamps = []
+    sids = []
+    snames = []
+    contents = []
     for msg in message_list:
         if msg.get("messagetype") == "RichText/Media_Album":
             continue
         raw_ts = msg.get("originalarrivaltime", "")
-        dt_local = parse_iso_to_local(raw_ts)
+        dt_utc = parse_iso_to_utc(raw_ts)
+        dt_local = utc_to_local(dt_utc) if dt_utc else None
 
         sender_id = msg.get("from", "")
+        if isinstance(sender_id, str):
+            sender_id = sys.intern(sender_id)
         sender_disp = msg.get("displayName") or sender_id
         content = msg.get("content", "") or ""
 
         if sender_id == user_id:
             sender_disp = "You"
         else:
-            if is_probably_system_id(sender_id, conversation_id):
+            is_system = system_cache.get(sender_id)
+            if is_system is None:
+                is_system = is_probably_system_id(sender_id, conversation_id)
+                system_cache[sender_id] = is_system
+            if is_system:
                 sender_disp = "System"
 
         if 'doc_id="' in content:
-            start = content.find('doc_id="') + len('doc_id="')
-            end = content.find('"', start)
-            if end != -1:
-                found_doc_id = content[start:end]
-                content = doc_id_to_md_link(found_doc_id)
+            doc_id_match = DOC_ID_RE.search(content)
+            if doc_id_match:
+                content = link_for(doc_id_match.group(1))
 
         content = convert_rich_text(content)
 
-        processed_msgs.append((dt_local, sender_id, sender_disp, content))
-
-    processed_msgs.sort(key=lambda x: x[0] if x[0] else datetime.min)
-
-    grouped = []
-    current_sender = None
-    current_sender_name = None
-    current_block = []
+        dts.append(dt_local)
+        # Sort and merge on UTC epoch seconds; unparseable timestamps sort
+        # first, as datetime.min did.
+        stamps.append(dt_utc.timestamp() if dt_utc else float("-inf"))
+        sids.append(sender_id)
+        snames.append(sender_disp)
+        contents.append(content)
 
-    for msg_dt, s_id, s_name, content in processed_msgs:
-        if s_id != current_sender:
-            if current_block:
-                grouped.append((current_sender_name, current_block))
-            current_sender = s_id
-            current_sender_name = s_name
-            current_block = []
-        current_block.append((msg_dt, content))
-
-    if current_block:
-        grouped.append((current_sender_name, current_block))
-
-    MERGE_SECONDS = 30
-    merged_grouped = []
-
-    for sender_name, block in grouped:
-        if not block:
-            continue
-
-        merged_block = []
-        cur_dt, cur_content = block[0]
-        sub_msgs = [cur_content]
-
-        for i in range(1, len(block)):
-            next_dt, next_content = block[i]
-            if not (cur_dt and next_dt):
-                merged_block.append((cur_dt, sub_msgs))
-                cur_dt, cur_content = next_dt, next_content
-                sub_msgs = [cur_content]
-                continue
-
-            delta = (next_dt - cur_dt).total_seconds()
-            if delta < MERGE_SECONDS:
-                sub_msgs.append(next_content)
-            else:
-                merged_block.append((cur_dt, sub_msgs))
-                cur_dt, cur_content = next_dt, next_content
-                sub_msgs = [cur_content]
-
-        merged_block.append((cur_dt, sub_msgs))
-        merged_grouped.append((sender_name, merged_block))
+    order = sorted(range(len(stamps)), key=stamps.__getitem__)
 
     out_name = f"{chat_name.replace(' ', '_')}.md"
-    with open(out_name, "w", encoding="utf-8") as out:
-        out.write(f"# Chat Export - {chat_name}\n\n")
-
-        for idx, (sender_name, block) in enumerate(merged_grouped):
+    with open(out_name, "wb", buffering=OUTPUT_BUFFER_SIZE) as out:
+        out.write(f"# Chat Export - {chat_name}\n\n".encode("utf-8"))
+
+        for idx, (sender_name, block) in enumerate(
+            merge_blocks(
+                group_by_sender(order, sids, snames),
+                dts,
+                stamps,
+                contents,
+                MERGE_SECONDS,
+            )
+        ):
+            buf = ["\n"] if idx else []
             for dt_local, sub_contents in block:
                 if dt_local:
                     time_str = format_dt(dt_local)
-                    out.write(f"**{sender_name}  {time_str}:**\n")
+                    buf.append(f"**{sender_name}  {time_str}:**\n")
                 else:
-                    out.write(f"**{sender_name}  [No Timestamp]:**\n")
+                    buf.append(f"**{sender_name}  [No Timestamp]:**\n")
 
                 for text in sub_contents:
-                    for line in text.split("\n"):
-                        out.write(f"  {line}\n")
-                out.write("\n")
-
-            if idx < len(merged_grouped) - 1:
-                out.write("\n")
+                    buf.append("  " + text.replace("\n", "\n  ") + "\n")
+                buf.append("\n")
+            out.write("".join(buf).encode("utf-8"))
 
     print(f"Exported to {out_name}")
 